@@ -10,8 +10,11 @@ Created on Fri Jan 21 13:11:56 2022
 import tensorflow as tf
 #import tensorflow_recommenders as tfrs
 import os as os
+import gc as gc
+import concurrent.futures as confut
 import pandas as pd
 import numpy as np
+from itertools import repeat
 import matplotlib.pyplot as plt
 
 ## functions
@@ -28,7 +31,7 @@ def h5totf(filabs, filanm, filtar, sitreq, shufle, batchn, trnper):
         full path to input feature data (anomalies)
     filtar : dictionary
         full path to the target variable
-    sitreq : list
+    sitreq : list or pd.CategoricalIndex
         list of fluxnet sites
     shufle : Boolean
         True if data needs to be shuffled
@@ -42,107 +45,160 @@ def h5totf(filabs, filanm, filtar, sitreq, shufle, batchn, trnper):
     -------
     retn01 : A tf.dataset with the training input features and target variables
     retn02 : A tf.dataset with the testing input features and target variables
-    retn03 : A vector with min values of the input features and target variables
-    retn04 : A vector with max values of the input features and target variables
+    retn03 : A vector with mean values of the input features (training data)
+    retn04 : A vector with variances of the input features (training data)
 
     """
     
-    # loop through the different input variables and create final dictionary
-    inpdat = {}
+    # collect the files of the input variables and create final dictionary
+    inpfil = {}
     for i in filabs.keys():
         print("var under process: " + i)
-        # read in the absolute values
-        tmpabs = pd.read_hdf(filabs[i])
-        #  read in the anomaly values
-        tmpanm = pd.read_hdf(filanm[i])
-        
-        # store the data in dictionary
-        inpdat[i] = tmpabs
-        inpdat[i+"anm"] = tmpanm
+        # absolute and anomaly values
+        inpfil[i] = filabs[i]
+        inpfil[i+"anm"] = filanm[i]
+    
+    # read the files in parallel (the reads are I/O bound, so threads suffice)
+    with confut.ThreadPoolExecutor(max_workers = 8) as h5pool:
+        mapinp = h5pool.map(h5read, inpfil.values(), repeat(sitreq))
+        maptar = h5pool.map(h5read, filtar.values(), repeat(sitreq))
+        inpdat = dict(zip(inpfil.keys(), mapinp))
+        tardat = dict(zip(filtar.keys(), maptar))
+    
     # target variable    
-    tardat = {}
-    for i in filtar.keys():
+    for i in tardat.keys():
         print("var under process: " + i)
-        tmptar = pd.read_hdf(filtar[i])
+        tmptar = tardat[i]
         #tmptar[tmptar > 10] = np.nan
-        tmptar[tmptar > 1] = 1.0
+        tmptar = tmptar.clip(upper = 1.0)
         tardat[i] = tmptar
     
     print(inpdat.keys())
         
-    # loop through the stations and create a final dataset containing only 
-    # the input variables
-    datlst = []
-    for i in sitreq:
-        print("site under process: " + i)
-        lsttmp = []
-        for j in inpdat.keys():
-            tmpvar = inpdat[j][i]
-            tmpvar.name = j
-            lsttmp.append(inpdat[j][i])
-        # create a data frame of variables for each 
-        # append the target stress
-        tartmp = tardat[list(tardat.keys())[0]][i]
-        tartmp.name = list(tardat.keys())[0]
-        lsttmp.append(tartmp)
-        dattmp = pd.concat(lsttmp, axis = 1)
-        dattmp = dattmp.replace(to_replace = -9999.0, value = np.nan)
-        dattmp = dattmp.replace(to_replace = -999.0, value = np.nan )
-        dattmp = dattmp.dropna(axis = 0, how = "any")
-        datlst.append(dattmp)
-            
-    del dattmp
+    # align all the variables on the time steps they have in common (the 
+    # remaining time steps would be dropped as missing values anyway)
+    print(" >> combining the sites into a single data block")
+    tarkey = list(tardat.keys())[0]
+    varkey = list(inpdat.keys()) + [tarkey]
+    vardat = list(inpdat.values()) + [tardat[tarkey]]
+    timcom = vardat[0].index
+    for j in vardat[1:]:
+        timcom = timcom.intersection(j.index)
+    
+    # fill a single preallocated block with one column per variable and the 
+    # rows ordered by (site, time)
+    datblk = np.empty((len(timcom) * len(sitreq), len(varkey)), 
+                      dtype = np.float32)
+    for k, j in enumerate(vardat):
+        tmpvar = j.reindex(index = timcom, columns = sitreq)
+        datblk[:, k] = tmpvar.to_numpy(dtype = np.float32).ravel(order = "F")
+    # free the raw data frames before the missing values are removed
+    del inpdat, tardat, vardat, tmpvar
+    gc.collect()
+    
+    # remove the missing values and create the final data block
+    datblk[np.isin(datblk, [-9999.0, -999.0])] = np.nan
+    datblk = datblk[~np.isnan(datblk).any(axis = 1)]
+    print(datblk.shape)
+    print(varkey)
+    
+    # separate the target variable from the input features
+    datarr = datblk[:, :-1]
+    tararr = datblk[:, -1]
     
-    # create the final pandas data frame
-    datfin = pd.concat(datlst, ignore_index = True)
-    datfin = datfin.dropna(axis = 0, how = "any")
-    print(datfin.shape)
-    print(datfin.columns)
-   
-    # reset index 
-    datfin = datfin.reset_index(drop = True)
+    # convert the data block to a tf.dataset
+    print(" >> Converting data block into a tensorflow dataset")
+    print(varkey[:-1])
+    print(datarr.shape)
     
     # shuffle the data
     if shufle == True:
         print(" >> shuffling data")
-        datfin = datfin.sample(frac = 1)
+        datprm = np.random.permutation(datarr.shape[0])
+        datarr, tararr = datarr[datprm], tararr[datprm]
     
-    # normalize by max 
-    print(" >> normalizing the data by max")
-    tarval = datfin.pop(list(tardat.keys())[0])
+    # free the combined block (still referenced by the views if not shuffled)
+    del datblk
+    gc.collect()
     
-    # calculate the max and min for backup
-    datmin = datfin.quantile(0.05)
-    datmax = datfin.quantile(1.00)
-    datfin = datfin/datmax
+    # size of the training dataset
+    trnsiz = int((trnper/100) * datarr.shape[0])
     
-    # convert the pandas data frame to a tf.dataset
-    print(" >> Converting data frame into a tensorflow dataset")
-    print(datfin.columns)
-    print(datfin.shape)
-    fullda = tf.data.Dataset.from_tensor_slices((datfin.values, 
-                                                 tarval.values))
+    # calculate the mean and variance for the normalization layer of the 
+    # model (from the training data only, so nothing leaks from the testing data)
+    print(" >> calculating the normalization statistics of the training data")
+    datmen = datarr[:trnsiz].mean(axis = 0, dtype = np.float64)
+    datvar = datarr[:trnsiz].var(axis = 0, dtype = np.float64)
     
-    # split into training and testing datasets
-    trnsiz = int((trnper/100) * len(datfin))
-    # training dataset
-    retn01 = fullda.take(trnsiz)
-    # testing dataset
-    retn02 = fullda.skip(trnsiz)
-        
+    # split into training and testing datasets (the slices are views, which 
+    # are copied once into tensors kept on the host memory)
+    with tf.device("/cpu:0"):
+        trnten = (tf.constant(datarr[:trnsiz]), tf.constant(tararr[:trnsiz]))
+        tstten = (tf.constant(datarr[trnsiz:]), tf.constant(tararr[trnsiz:]))
+    del datarr, tararr
+    retn01 = tf.data.Dataset.from_tensor_slices(trnten)
+    retn02 = tf.data.Dataset.from_tensor_slices(tstten)
+    # training dataset (reshuffled every epoch and prefetched)
     if shufle == True:
-        retn01 = retn01.shuffle(trnsiz)
-        tstsiz = len(datfin) - trnsiz
-        retn02 = retn02.shuffle(tstsiz)
-        
-    retn01 = retn01.batch(batchn)
+        # the rows are already shuffled once above, so a bounded buffer 
+        # is enough to reshuffle the training data every epoch
+        retn01 = retn01.shuffle(min(trnsiz, 100000), 
+                                reshuffle_each_iteration = True)
+    retn01 = retn01.batch(batchn, drop_remainder = True)
+    retn01 = retn01.prefetch(tf.data.AUTOTUNE)
+    # testing dataset (the order of the evaluation data does not matter)
     retn02 = retn02.batch(batchn)
-    retn03 = datmin
-    retn04 = datmax
+    retn02 = retn02.prefetch(tf.data.AUTOTUNE)
+    retn03 = datmen
+    retn04 = datvar
     
     return retn01, retn02, retn03, retn04
 
+# function to read the required sites from an hdf5 file
+def h5read(filnam, sitreq, chnksz = 1000):
+    """
+    Script to read the data of the required fluxnet sites from an hdf5 file. 
+    Files stored in the "table" format are read in blocks of time steps and 
+    only the required sites of every block are kept, so the full file is never 
+    held in memory (the whole rows are still read from disk, which is slower 
+    than reading the "fixed" format). Files in the "fixed" format can only be 
+    read entirely before subsetting. The data is returned in single precision, 
+    which is what the deep neural network uses
+
+    Parameters
+    ----------
+    filnam : string
+        full path to the hdf5 file
+    sitreq : list or pd.CategoricalIndex
+        list of fluxnet sites
+    chnksz : integer, optional
+        number of time steps read at a time from a "table" file
+
+    Returns
+    -------
+    retn01 : A pandas data frame (time x sites) with only the required sites
+
+    """
+    with pd.HDFStore(filnam, mode = "r") as h5stor:
+        # like pd.read_hdf, only files with a single dataset can be read
+        if len(h5stor.keys()) != 1:
+            raise ValueError("key must be provided when HDF5 file contains "
+                             "multiple datasets: " + filnam)
+        h5keys = h5stor.keys()[0]
+        if h5stor.get_storer(h5keys).is_table:
+            # the column selection is applied to every block after it has 
+            # been read, so only one block holds the other sites
+            tmpblk = h5stor.select(h5keys, columns = list(sitreq), 
+                                   chunksize = chnksz)
+            retn01 = pd.concat([j for j in tmpblk])
+        else:
+            retn01 = h5stor.get(h5keys).loc[:, sitreq]
+    retn01 = retn01.astype(np.float32, copy = False)
+    
+    return retn01
+
 # kling gupta efficiency
+@tf.function(jit_compile = True)
 def kge(actual, predct):
     """
     a custom loss function based on the Kling Gupta Efficiency
@@ -151,6 +207,8 @@ def kge(actual, predct):
                Implications for improving hydrological modelling. (2009). 
                Journal of Hydrology, 377(1–2), 80–91. 
                DOI: https://doi.org/10.1016/j.jhydrol.2009.08.003
+    the means, standard deviations and covariance are derived from sums 
+    computed in a single pass over the data, which XLA fuses into one kernel
 
     Parameters
     ----------
@@ -165,18 +223,30 @@ def kge(actual, predct):
         The loss function to be minimized
 
     """
+    # >>> first and second order moments
+    crsprd = tf.multiply(actual, predct)
+    actnum = tf.cast(tf.size(actual), actual.dtype)
+    prenum = tf.cast(tf.size(predct), predct.dtype)
+    crsnum = tf.cast(tf.size(crsprd), crsprd.dtype)
+    acmean = tf.math.reduce_sum(actual) / actnum
+    pdmean = tf.math.reduce_sum(predct) / prenum
+    acmsqr = tf.math.reduce_sum(tf.multiply(actual, actual)) / actnum
+    pdmsqr = tf.math.reduce_sum(tf.multiply(predct, predct)) / prenum
+    crsmen = tf.math.reduce_sum(crsprd) / crsnum
+    # (the small epsilon keeps the gradient of the square root finite when 
+    #  float32 cancellation pushes the variance of a near-constant batch to 0)
+    actstd = tf.math.sqrt(tf.math.maximum(acmsqr - acmean**2, 0.0) + 1e-8)
+    prestd = tf.math.sqrt(tf.math.maximum(pdmsqr - pdmean**2, 0.0) + 1e-8)
+    
     # >>> correlation
-    acmean = tf.math.reduce_mean(actual)
-    pdmean = tf.math.reduce_mean(predct)
-    acmdev, pdmdev = actual - acmean, predct - pdmean
-    cornum = tf.math.reduce_mean(tf.multiply(acmdev, pdmdev))        
-    corden = tf.math.reduce_std(acmdev) * tf.math.reduce_std(pdmdev)
+    # (removing the mean does not change the standard deviation, so the 
+    #  denominator is simply the product of the two standard deviations)
+    cornum = crsmen - acmean * pdmean
+    corden = actstd * prestd
     corcof = cornum / corden
     cratio = (corcof - 1)**2
     
     # variability ratio
-    actstd = tf.math.reduce_std(actual)
-    prestd = tf.math.reduce_std(predct)
     stdrat = prestd / actstd
     vratio = (stdrat - 1)**2
     
@@ -190,7 +260,7 @@ def kge(actual, predct):
     return retn01
 
 # deep learning model
-def funmod(inpshp, losobj, metric, optmod):
+def funmod(inpshp, losobj, metric, optmod, nrmmen, nrmvar):
     """
     Function to create a machine learning model using the Functional API module
     of tensorflow. This module can be used to create more powerful machine
@@ -206,6 +276,10 @@ def funmod(inpshp, losobj, metric, optmod):
         A tensorflow error metric function
     optmod : character
         An optimizer which is available in tensorflow
+    nrmmen : array
+        The mean values of the input variables used to normalize the inputs
+    nrmvar : array
+        The variances of the input variables used to normalize the inputs
 
     Returns
     -------
@@ -216,18 +290,22 @@ def funmod(inpshp, losobj, metric, optmod):
     print(" >>> creating a Functional API model")
     # define the input layers
     inplyr = tf.keras.Input(shape = (inpshp, ))
+    # normalize the inputs (kept in float32 under mixed precision)
+    nrmlyr = tf.keras.layers.Normalization(mean = nrmmen, 
+                                           variance = nrmvar, 
+                                           dtype = "float32")(inplyr)
     
-    crslyr = tf.keras.layers.Dense(512, activation=tf.nn.swish)(inplyr)
+    crslyr = tf.keras.layers.Dense(512, activation=tf.nn.swish)(nrmlyr)
     crslyr = tf.keras.layers.Dropout(0.45)(crslyr)
     crslyr = tf.keras.layers.Dense(256, activation=tf.nn.swish)(crslyr)
     crslyr = tf.keras.layers.Dropout(0.3)(crslyr)
     
-    seqlyr = tf.keras.layers.Dense(792, activation=tf.nn.swish)(inplyr)
+    seqlyr = tf.keras.layers.Dense(792, activation=tf.nn.swish)(nrmlyr)
     seqlyr = tf.keras.layers.Dropout(0.45)(seqlyr)
     seqlyr = tf.keras.layers.Dense(512, activation=tf.nn.gelu)(seqlyr)
     seqlyr = tf.keras.layers.Dropout(0.45)(seqlyr)
   
-    concat = tf.keras.layers.concatenate([crslyr, seqlyr, inplyr])
+    concat = tf.keras.layers.concatenate([crslyr, seqlyr, nrmlyr])
     
     # construct the last part of the model
     outlyr = tf.keras.layers.Dense(768, activation=tf.nn.swish)(concat)
@@ -237,17 +315,15 @@ def funmod(inpshp, losobj, metric, optmod):
     outlyr = tf.keras.layers.Dense(256, activation=tf.nn.swish)(outlyr)
     outlyr = tf.keras.layers.Dropout(0.4)(outlyr)
 
-    conca1 = tf.keras.layers.concatenate([outlyr, inplyr])
-    outly1 = tf.keras.layers.Dense(256, activation=tf.nn.swish)(conca1)
-    outly1 = tf.keras.layers.Dropout(0.3)(outly1)
     outly1 = tf.keras.layers.Dense(172, activation=tf.nn.swish)(outlyr)
-    outly1 = tf.keras.layers.Dropout(0.35)(outlyr)
+    outly1 = tf.keras.layers.Dropout(0.35)(outly1)
     
-    conca2 = tf.keras.layers.concatenate([outly1, inplyr])
+    conca2 = tf.keras.layers.concatenate([outly1, nrmlyr])
     outly2 = tf.keras.layers.Dense(128, activation=tf.nn.swish)(conca2)
     outly2 = tf.keras.layers.Dropout(0.3)(outly2)
     outly2 = tf.keras.layers.Dense(64, activation=tf.nn.gelu)(outly2)
-    outmod = tf.keras.layers.Dense(6)(outly2)
+    # keep the output in float32 so that the loss is computed in full precision
+    outmod = tf.keras.layers.Dense(6, dtype = "float32")(outly2)
     
     # combine the layers into a full model
     tmpmod = tf.keras.Model(inputs = inplyr, 
@@ -258,10 +334,12 @@ def funmod(inpshp, losobj, metric, optmod):
     losobj = losobj
     # define a metric function
     metric = [metric]
-    # compile the model
+    # compile the model (with XLA, which fuses the dense/activation/dropout 
+    # layers into fewer kernels)
     tmpmod.compile(optimizer = optmod, 
                    loss = losobj, 
-                   metrics = metric)
+                   metrics = metric,
+                   jit_compile = True)
     # return the compiled model
     retn01 = tmpmod
     
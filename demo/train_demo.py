@@ -54,38 +54,57 @@ outdir = "<< Specify path to input data here >>"
 outfil = os.path.join(outdir, "stressnet_demo")
 
 #%% main code
+
+## use mixed precision (float16 compute, float32 weights) on gpus
+mxprec = len(tf.config.list_physical_devices("GPU")) > 0
+if mxprec == True:
+    tf.keras.mixed_precision.set_global_policy("mixed_float16")
+
+## distribute the training over all the available devices (the batch size 
+## and the learning rate are scaled linearly with the number of replicas)
+strtgy = tf.distribute.MirroredStrategy()
+nrepli = strtgy.num_replicas_in_sync
     
 # read in the fluxnet site locations
 flxsit = pd.read_hdf(path_or_buf = flxnet["stn"],   key="site")
 flxsit = flxsit.dropna(how = "any")
     
 ## select the required cluster
-sitreq = flxsit.index
+sitreq = pd.CategoricalIndex(flxsit.index)
     
 ## create a combined tensorflow dataset
-trndat, tstdat, sclmin, sclmax = sf.h5totf(filabs = absfil, 
+trndat, tstdat, nrmmen, nrmvar = sf.h5totf(filabs = absfil, 
                                             filanm = anmfil, 
                                             filtar = tarfil,
                                             sitreq = sitreq,
                                             shufle = True,
-                                            batchn = 100,
+                                            batchn = 100 * nrepli,
                                             trnper = 85)
     
 ## get the required model 
-tstmod = sf.funmod(inpshp = 12, 
-                   losobj = sf.kge, # specifiy the loss function (KGE in this case)
-                   metric = sf.kge, # specify the validation metric (KGE in this case)
-                   optmod = tf.keras.optimizers.Adam(learning_rate = 0.000142)) # specify the optimizer you want to use.  
+with strtgy.scope():
+    optmod = tf.keras.optimizers.Adam(learning_rate = 0.000142 * nrepli) # specify the optimizer you want to use.
+    if mxprec == True:
+        optmod = tf.keras.mixed_precision.LossScaleOptimizer(optmod)
+    tstmod = sf.funmod(inpshp = 12, 
+                       losobj = sf.kge, # specifiy the loss function (KGE in this case)
+                       metric = sf.kge, # specify the validation metric (KGE in this case)
+                       optmod = optmod,
+                       nrmmen = nrmmen,
+                       nrmvar = nrmvar)
 
 ## train the dataset
 histst = tstmod.fit(trndat, 
                     epochs = 700, # specify the number of epochs or iterations
                     validation_data = tstdat)
 
-## plot evolution
+## save the evolution of the loss function (and plot it when a display is 
+## available, i.e. the matplotlib backend is not the headless "agg")
 evolut = pd.DataFrame(histst.history)
 evorms = evolut[["kge","val_kge"]]
-evorms.plot()
+evorms.to_csv(outfil + "_history.csv")
+if plt.get_backend().lower() != "agg":
+    evorms.plot()
     
 # save the model
 tstmod.save(outfil)
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+-------------------------------------------------------------------------------
+Python Script for Rewriting the StressNet Input Data into the HDF5 "table"
+Format
+-------------------------------------------------------------------------------
+Author: Akash Koppa
+Affiliation: Hydro-Climate Extremes Lab (H-CEL), Ghent University, Belgium
+Contact:  akash.koppa@ugent.be
+-------------------------------------------------------------------------------
+NOTE: The input data is distributed in the "fixed" format, which can only be
+read in its entirety. Files in the "table" format are read by the training
+scripts in blocks of time steps, keeping only the required fluxnet sites of
+every block, so a full file is never held in memory. PyTables tables are
+stored by row, so the whole rows are still read from disk and reading them is
+generally slower than reading the "fixed" format: only convert when memory,
+not read time, is the limit.
+-------------------------------------------------------------------------------
+"""
+
+## import libraries
+import os as os
+import glob as glob
+import pandas as pd
+
+## user defined configuration
+inpdir = "<< Specify path to input data here >>"
+
+# output path for the rewritten input data (can be the same as inpdir)
+outdir = "<< Specify path to output data here >>"
+
+## main code
+def main():
+    """
+    Main control script
+
+    Returns
+    -------
+    A copy of every hdf5 file in the input folder in the "table" format
+    """
+
+    os.makedirs(outdir, exist_ok = True)
+    for i in sorted(glob.glob(os.path.join(inpdir, "*.h5"))):
+        print("file under process: " + os.path.basename(i))
+        # read in the data along with the keys it is stored under
+        with pd.HDFStore(i, mode = "r") as h5stor:
+            tmpdat = {j: h5stor.get(j) for j in h5stor.keys()}
+
+        # write the data back using the table format
+        h5mode = "w"
+        for j in tmpdat.keys():
+            tmpdat[j].to_hdf(os.path.join(outdir, os.path.basename(i)),
+                             key = j,
+                             mode = h5mode,
+                             format = "table")
+            h5mode = "a"
+
+## run the main script
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+-------------------------------------------------------------------------------
+Python Script for Converting the StressNet Input Data into Per-Site TFRecord
+Shards
+-------------------------------------------------------------------------------
+Author: Akash Koppa
+Affiliation: Hydro-Climate Extremes Lab (H-CEL), Ghent University, Belgium
+Contact:  akash.koppa@ugent.be
+-------------------------------------------------------------------------------
+NOTE: The input files of the selected training script are combined in the same
+way as during training and every fluxnet site is written to its own TFRecord
+file. Setting "shrdir" in the training script to the output folder then
+streams the shards from disk instead of loading the full data into memory.
+When all the input files are in the "table" format (see h5_to_table.py), the
+data is converted in windows of time steps and only the rows of one window
+are read and combined in memory at a time. Files in the "fixed" format can
+only be read entirely, so the input data is then converted in a single pass
+and the full input data has to fit in memory.
+-------------------------------------------------------------------------------
+"""
+
+## import libraries
+import tensorflow as tf
+import os as os
+import importlib as importlib
+import pandas as pd
+import numpy as np
+
+## user defined configuration
+# training script with the input configuration to be converted
+# ("train_short_vegetation" or "train_tall_vegetation")
+trnscr = "train_short_vegetation"
+
+# output path for the TFRecord shards (one per fluxnet site)
+shrdir = "<< Specify path to output data here >>"
+
+# number of time steps combined in memory at a time ("table" format only)
+timstp = 1000
+
+## main code
+def main():
+    """
+    Main control script
+
+    Returns
+    -------
+    One TFRecord file per fluxnet site with the input features ("inp") and the
+    target variable ("tar") of every time step
+    """
+
+    ## get the input configuration of the training script
+    trnmod = importlib.import_module(trnscr)
+
+    ## get the list of stations to subset the input data
+    # read in the fluxnet site locations
+    flxsit = pd.read_hdf(path_or_buf = trnmod.flxnet["stn"], key = trnmod.sitkey)
+    flxsit = flxsit.dropna(how = "any")
+    sitreq = pd.CategoricalIndex(flxsit.index)
+
+    ## get the windows of time steps to be converted
+    h5fils = (list(trnmod.absfil.values()) + list(trnmod.anmfil.values()) + 
+              list(trnmod.tarfil.values()))
+    h5tabl = []
+    for i in h5fils:
+        with pd.HDFStore(i, mode = "r") as h5stor:
+            h5tabl.append(h5stor.get_storer(h5stor.keys()[0]).is_table)
+    if all(h5tabl):
+        # windows based on the time steps of the target variable (the other
+        # time steps are dropped while combining the variables anyway)
+        with pd.HDFStore(h5fils[-1], mode = "r") as h5stor:
+            timidx = pd.Index(h5stor.select_column(h5stor.keys()[0], "index"))
+        timwin = [(timidx[k], timidx[min(k + timstp, len(timidx)) - 1]) 
+                  for k in range(0, len(timidx), timstp)]
+    else:
+        print(" >> input data not in the table format, converting in a " 
+              "single pass (the full input data has to fit in memory)")
+        timwin = [None]
+
+    ## convert the data window by window (one shard per site)
+    os.makedirs(shrdir, exist_ok = True)
+    tfrwrt = {i: tf.io.TFRecordWriter(os.path.join(shrdir, i + ".tfrecord"))
+              for i in sitreq}
+    tfrcnt = dict.fromkeys(sitreq, 0)
+    for w in timwin:
+        if w is not None:
+            print("time steps under process: " + str(w[0]) + " - " + str(w[1]))
+        # combine the input data of the window (rows ordered by site)
+        datblk, varkey, sitidx = trnmod.h5blck(filabs = trnmod.absfil,
+                                               filanm = trnmod.anmfil,
+                                               filtar = trnmod.tarfil,
+                                               sitreq = sitreq,
+                                               timwin = w)
+
+        # write the rows of every site to its own shard
+        sitblk = np.split(datblk, 
+                          np.searchsorted(sitidx, np.arange(1, len(sitreq))))
+        for i, j in zip(sitreq, sitblk):
+            for k in j:
+                tfrftr = {"inp": tf.train.Feature(
+                              float_list = tf.train.FloatList(value = k[:-1])),
+                          "tar": tf.train.Feature(
+                              float_list = tf.train.FloatList(value = k[-1:]))}
+                tfrexm = tf.train.Example(
+                    features = tf.train.Features(feature = tfrftr))
+                tfrwrt[i].write(tfrexm.SerializeToString())
+            tfrcnt[i] = tfrcnt[i] + len(j)
+        del datblk, sitidx, sitblk
+
+    # close the shards and remove the ones of sites without any valid data
+    for i in sitreq:
+        tfrwrt[i].close()
+        if tfrcnt[i] == 0:
+            os.remove(os.path.join(shrdir, i + ".tfrecord"))
+
+## run the main script
+if __name__ == "__main__":
+    main()
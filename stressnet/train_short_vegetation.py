@@ -19,8 +19,11 @@ DOI: 10.21203/rs.3.rs-827869/v1
 ## import libraries
 import tensorflow as tf
 import os as os
+import gc as gc
+import concurrent.futures as confut
 import pandas as pd
 import numpy as np
+from itertools import repeat
 import matplotlib.pyplot as plt
 
 ## user defined configuration
@@ -28,6 +31,7 @@ inpdir = "<< Specify path to input data here >>"
 
 # station
 flxnet = {"stn": (os.path.join(inpdir, "sites_short_vegetation.h5"))} # sites
+sitkey = "siteda" # key of the site locations in the hdf5 file
 # input features (absolute values)
 absfil = {"ate": (os.path.join(inpdir, "ate_short_vegetation.h5")), # air temperature
           "co2": (os.path.join(inpdir, "co2_short_vegetation.h5")), # carbon di oxide
@@ -51,6 +55,11 @@ tarfil = {"str": (os.path.join(inpdir, "str_short_vegetation.h5"))} # transpirat
 outdir = "<< Specify path to input data here >>"
 outfil = os.path.join(outdir, "stressnet_short_vegetation")
 
+# optional folder with the per-site TFRecord shards written by h5_to_tfrecord.py
+# (None reads the hdf5 files into memory, otherwise the shards are streamed 
+# from disk, which is the option to use when the data does not fit in memory)
+shrdir = None
+
 ## main code
 def main():
     """
@@ -61,36 +70,62 @@ def main():
     A trained machine learning model with the required stress formulation
     """
     
+    ## use mixed precision (float16 compute, float32 weights) on gpus
+    mxprec = len(tf.config.list_physical_devices("GPU")) > 0
+    if mxprec == True:
+        tf.keras.mixed_precision.set_global_policy("mixed_float16")
+    
+    ## distribute the training over all the available devices (the batch size 
+    ## and the learning rate are scaled linearly with the number of replicas)
+    strtgy = tf.distribute.MirroredStrategy()
+    nrepli = strtgy.num_replicas_in_sync
+    
     ## get the list of stations to subset the input data 
     # read in the fluxnet site locations
-    flxsit = pd.read_hdf(path_or_buf = flxnet["stn"],   key="siteda")
+    flxsit = pd.read_hdf(path_or_buf = flxnet["stn"],   key=sitkey)
     flxsit = flxsit.dropna(how = "any")
-    sitreq = flxsit.index
+    sitreq = pd.CategoricalIndex(flxsit.index)
     
     ## create a combined tensorflow dataset
-    trndat, tstdat, sclmin, sclmax = h5totf(filabs = absfil, 
-                                            filanm = anmfil, 
-                                            filtar = tarfil,
-                                            sitreq = sitreq,
-                                            shufle = True,
-                                            batchn = 100,
-                                            trnper = 85)
+    if shrdir is None:
+        trndat, tstdat, nrmmen, nrmvar = h5totf(filabs = absfil, 
+                                                filanm = anmfil, 
+                                                filtar = tarfil,
+                                                sitreq = sitreq,
+                                                shufle = True,
+                                                batchn = 100 * nrepli,
+                                                trnper = 85)
+    else:
+        trndat, tstdat, nrmmen, nrmvar = tfrctf(shrdir = shrdir,
+                                                inpshp = 12,
+                                                shufle = True,
+                                                batchn = 100 * nrepli,
+                                                trnper = 85)
 
     ## get the required model 
-    tstmod = funmod(inpshp = 12, 
-                    losobj = kge,
-                    metric = kge,
-                    optmod = tf.keras.optimizers.Adam(learning_rate = 0.000142))
+    with strtgy.scope():
+        optmod = tf.keras.optimizers.Adam(learning_rate = 0.000142 * nrepli)
+        if mxprec == True:
+            optmod = tf.keras.mixed_precision.LossScaleOptimizer(optmod)
+        tstmod = funmod(inpshp = 12, 
+                        losobj = kge,
+                        metric = kge,
+                        optmod = optmod,
+                        nrmmen = nrmmen,
+                        nrmvar = nrmvar)
 
     ## train the deep learning model
     histst = tstmod.fit(trndat,
                         epochs = 900,
                         validation_data = tstdat)
 
-    ## plot evolution of the loss function
+    ## save the evolution of the loss function (and plot it when a display is 
+    ## available, i.e. the matplotlib backend is not the headless "agg")
     evolut = pd.DataFrame(histst.history)
     evorms = evolut[["kge","val_kge"]]
-    evorms.plot()
+    evorms.to_csv(outfil + "_history.csv")
+    if plt.get_backend().lower() != "agg":
+        evorms.plot()
 
     ## save the model
     tstmod.save(outfil)
@@ -111,7 +146,7 @@ def h5totf(filabs, filanm, filtar, sitreq, shufle, batchn, trnper):
         full path to input feature data (anomalies)
     filtar : dictionary
         full path to the target variable
-    sitreq : list
+    sitreq : list or pd.CategoricalIndex
         list of fluxnet sites
     shufle : Boolean
         True if data needs to be shuffled
@@ -125,107 +160,312 @@ def h5totf(filabs, filanm, filtar, sitreq, shufle, batchn, trnper):
     -------
     retn01 : A tf.dataset with the training input features and target variables
     retn02 : A tf.dataset with the testing input features and target variables
-    retn03 : A vector with min values of the input features and target variables
-    retn04 : A vector with max values of the input features and target variables
+    retn03 : A vector with mean values of the input features (training data)
+    retn04 : A vector with variances of the input features (training data)
 
     """
     
-    # loop through the different input variables and create final dictionary
-    inpdat = {}
+    # read the hdf5 files and combine them into a single data block
+    datblk, varkey, sitidx = h5blck(filabs, filanm, filtar, sitreq)
+    
+    # separate the target variable from the input features
+    datarr = datblk[:, :-1]
+    tararr = datblk[:, -1]
+    
+    # convert the data block to a tf.dataset
+    print(" >> Converting data block into a tensorflow dataset")
+    print(varkey[:-1])
+    print(datarr.shape)
+    
+    # shuffle the data
+    if shufle == True:
+        print(" >> shuffling data")
+        datprm = np.random.permutation(datarr.shape[0])
+        datarr, tararr = datarr[datprm], tararr[datprm]
+    
+    # free the combined block (still referenced by the views if not shuffled)
+    del datblk, sitidx
+    gc.collect()
+    
+    # size of the training dataset
+    trnsiz = int((trnper/100) * datarr.shape[0])
+    
+    # calculate the mean and variance for the normalization layer of the 
+    # model (from the training data only, so nothing leaks from the testing data)
+    print(" >> calculating the normalization statistics of the training data")
+    datmen = datarr[:trnsiz].mean(axis = 0, dtype = np.float64)
+    datvar = datarr[:trnsiz].var(axis = 0, dtype = np.float64)
+    
+    # split into training and testing datasets (the slices are views, which 
+    # are copied once into tensors kept on the host memory)
+    with tf.device("/cpu:0"):
+        trnten = (tf.constant(datarr[:trnsiz]), tf.constant(tararr[:trnsiz]))
+        tstten = (tf.constant(datarr[trnsiz:]), tf.constant(tararr[trnsiz:]))
+    del datarr, tararr
+    retn01 = tf.data.Dataset.from_tensor_slices(trnten)
+    retn02 = tf.data.Dataset.from_tensor_slices(tstten)
+    # training dataset (reshuffled every epoch and prefetched)
+    if shufle == True:
+        # the rows are already shuffled once above, so a bounded buffer 
+        # is enough to reshuffle the training data every epoch
+        retn01 = retn01.shuffle(min(trnsiz, 100000), 
+                                reshuffle_each_iteration = True)
+    retn01 = retn01.batch(batchn, drop_remainder = True)
+    retn01 = retn01.prefetch(tf.data.AUTOTUNE)
+    # testing dataset (the order of the evaluation data does not matter)
+    retn02 = retn02.batch(batchn)
+    retn02 = retn02.prefetch(tf.data.AUTOTUNE)
+    retn03 = datmen
+    retn04 = datvar
+    
+    return retn01, retn02, retn03, retn04
+
+# function to combine the input hdf5 files into a single data block
+def h5blck(filabs, filanm, filtar, sitreq, timwin = None):
+    """
+    Script to read the input hdf5 files and combine the required fluxnet sites 
+    into a single block of input features and target variable, without the 
+    missing values
+
+    Parameters
+    ----------
+    filabs : dictionary
+        full paths to input feature data (absolute values)
+    filanm : dictionary
+        full path to input feature data (anomalies)
+    filtar : dictionary
+        full path to the target variable
+    sitreq : list or pd.CategoricalIndex
+        list of fluxnet sites
+    timwin : tuple, optional
+        first and last time step to be combined (both included), by default 
+        all the time steps are combined
+
+    Returns
+    -------
+    retn01 : A float32 array (rows x variables), with the target variable as 
+             the last column and the rows ordered by (site, time)
+    retn02 : A list with the names of the variables (columns of retn01)
+    retn03 : A vector with the position in sitreq of the site of every row
+
+    """
+    
+    # collect the files of the input variables and create final dictionary
+    inpfil = {}
     for i in filabs.keys():
         print("var under process: " + i)
-        # read in the absolute values
-        tmpabs = pd.read_hdf(filabs[i])
-        #  read in the anomaly values
-        tmpanm = pd.read_hdf(filanm[i])
-        
-        # store the data in dictionary
-        inpdat[i] = tmpabs
-        inpdat[i+"anm"] = tmpanm
+        # absolute and anomaly values
+        inpfil[i] = filabs[i]
+        inpfil[i+"anm"] = filanm[i]
+    
+    # read the files in parallel (the reads are I/O bound, so threads suffice)
+    with confut.ThreadPoolExecutor(max_workers = 8) as h5pool:
+        mapinp = h5pool.map(h5read, inpfil.values(), repeat(sitreq), 
+                            repeat(timwin))
+        maptar = h5pool.map(h5read, filtar.values(), repeat(sitreq), 
+                            repeat(timwin))
+        inpdat = dict(zip(inpfil.keys(), mapinp))
+        tardat = dict(zip(filtar.keys(), maptar))
+    
     # target variable    
-    tardat = {}
-    for i in filtar.keys():
+    for i in tardat.keys():
         print("var under process: " + i)
-        tmptar = pd.read_hdf(filtar[i])
-        tmptar[tmptar > 1] = 1.0
+        tmptar = tardat[i]
+        tmptar = tmptar.clip(upper = 1.0)
         tardat[i] = tmptar
     
     print(inpdat.keys())
         
-    # loop through the stations and create a final dataset containing only 
-    #   the input variables
-    datlst = []
-    for i in sitreq:
-        print("site under process: " + i)
-        lsttmp = []
-        for j in inpdat.keys():
-            tmpvar = inpdat[j][i]
-            tmpvar.name = j
-            lsttmp.append(inpdat[j][i])
-        # create a data frame of variables for each 
-        # append the target stress
-        tartmp = tardat[list(tardat.keys())[0]][i]
-        tartmp.name = list(tardat.keys())[0]
-        lsttmp.append(tartmp)
-        dattmp = pd.concat(lsttmp, axis = 1)
-        dattmp = dattmp.replace(to_replace = -9999.0, value = np.nan)
-        dattmp = dattmp.replace(to_replace = -999.0, value = np.nan )
-        dattmp = dattmp.dropna(axis = 0, how = "any")
-        datlst.append(dattmp)
-            
-    del dattmp
-    
-    # create the final pandas data frame
-    datfin = pd.concat(datlst, ignore_index = True)
-    datfin = datfin.dropna(axis = 0, how = "any")
-    print(datfin.shape)
-    print(datfin.columns)
-   
-    # reset index 
-    datfin = datfin.reset_index(drop = True)
+    # align all the variables on the time steps they have in common (the 
+    # remaining time steps would be dropped as missing values anyway)
+    print(" >> combining the sites into a single data block")
+    tarkey = list(tardat.keys())[0]
+    varkey = list(inpdat.keys()) + [tarkey]
+    vardat = list(inpdat.values()) + [tardat[tarkey]]
+    timcom = vardat[0].index
+    for j in vardat[1:]:
+        timcom = timcom.intersection(j.index)
     
-    # shuffle the data
+    # fill a single preallocated block with one column per variable and the 
+    # rows ordered by (site, time)
+    datblk = np.empty((len(timcom) * len(sitreq), len(varkey)), 
+                      dtype = np.float32)
+    for k, j in enumerate(vardat):
+        tmpvar = j.reindex(index = timcom, columns = sitreq)
+        datblk[:, k] = tmpvar.to_numpy(dtype = np.float32).ravel(order = "F")
+    # free the raw data frames before the missing values are removed
+    del inpdat, tardat, vardat, tmpvar
+    gc.collect()
+    
+    # remove the missing values and create the final data block
+    datblk[np.isin(datblk, [-9999.0, -999.0])] = np.nan
+    datnan = np.isnan(datblk).any(axis = 1)
+    datblk = datblk[~datnan]
+    sitidx = np.repeat(np.arange(len(sitreq)), len(timcom))[~datnan]
+    print(datblk.shape)
+    print(varkey)
+    retn01 = datblk
+    retn02 = varkey
+    retn03 = sitidx
+    
+    return retn01, retn02, retn03
+
+# function to stream the per-site tfrecord shards
+def tfrctf(shrdir, inpshp, shufle, batchn, trnper):
+    """
+    Script to stream the per-site TFRecord shards (written by 
+    h5_to_tfrecord.py) into tensorflow datasets, without loading the full data 
+    into memory. The data is divided into training and testing datasets by site
+
+    Parameters
+    ----------
+    shrdir : string
+        folder with the TFRecord shards (one per fluxnet site)
+    inpshp : integer
+        The number of input variables
+    shufle : Boolean
+        True if data needs to be shuffled
+    batchn : integer
+        number of batches into which the data needs to divided into
+    trnper : integer
+        percentage between 0 and 100 based on which the sites will be 
+        divided into training and testing dataset
+
+    Returns
+    -------
+    retn01 : A tf.dataset with the training input features and target variables
+    retn02 : A tf.dataset with the testing input features and target variables
+    retn03 : A vector with mean values of the input features (training data)
+    retn04 : A vector with variances of the input features (training data)
+
+    """
+    
+    # list the shards and divide the sites into training and testing
+    shrfil = np.array(sorted(tf.io.gfile.glob(os.path.join(shrdir, 
+                                                           "*.tfrecord"))))
+    if len(shrfil) == 0:
+        raise FileNotFoundError("no *.tfrecord shards found in: " + shrdir)
     if shufle == True:
-        print(" >> shuffling data")
-        datfin = datfin.sample(frac = 1)
+        shrfil = shrfil[np.random.permutation(len(shrfil))]
+    trnsiz = int((trnper/100) * len(shrfil))
+    if trnsiz == 0:
+        raise ValueError("no sites left for training with trnper = " + 
+                         str(trnper) + " and " + str(len(shrfil)) + " shards")
+    print(" >> sites for training: " + str(trnsiz) + 
+          ", sites for testing: " + str(len(shrfil) - trnsiz))
     
+    # parse a batch of serialized examples into input features and target
+    shrftr = {"inp": tf.io.FixedLenFeature([inpshp], tf.float32),
+              "tar": tf.io.FixedLenFeature([], tf.float32)}
+    def shrprs(serexm):
+        tmpexm = tf.io.parse_example(serexm, shrftr)
+        return tmpexm["inp"], tmpexm["tar"]
     
-    # normalize by max
-    print(" >> normalizing the data by max")
-    tarval = datfin.pop(list(tardat.keys())[0])
+    # read the shards of several sites at the same time
+    def shrred(filnam, filshf):
+        tmpdat = tf.data.Dataset.from_tensor_slices(filnam)
+        if filshf == True:
+            tmpdat = tmpdat.shuffle(len(filnam), reshuffle_each_iteration = True)
+        return tmpdat.interleave(tf.data.TFRecordDataset, 
+                                 cycle_length = 16, 
+                                 num_parallel_calls = tf.data.AUTOTUNE, 
+                                 deterministic = False)
     
-    # calculate the max and min for backup
-    datmin = datfin.quantile(0.05)
-    datmax = datfin.quantile(0.95)
-    datfin = datfin/datmax
-
-    # convert the pandas data frame to a tf.dataset
-    print(" >> Converting data frame into a tensorflow dataset")
-    print(datfin.columns)
-    print(datfin.shape)
-    fullda = tf.data.Dataset.from_tensor_slices((datfin.values, 
-                                                 tarval.values))
+    # calculate the mean and variance of the training data in a single 
+    # streaming pass (for the normalization layer of the model)
+    print(" >> calculating the normalization statistics of the training data")
+    tmpsum = shrred(shrfil[:trnsiz], False).batch(10000).map(
+        shrprs, num_parallel_calls = tf.data.AUTOTUNE).reduce(
+        (tf.zeros([inpshp], tf.float64), tf.zeros([inpshp], tf.float64), 
+         tf.constant(0.0, tf.float64)),
+        lambda oldsum, tmpbat: (
+            oldsum[0] + tf.reduce_sum(tf.cast(tmpbat[0], tf.float64), axis = 0),
+            oldsum[1] + tf.reduce_sum(tf.cast(tmpbat[0], tf.float64)**2, axis = 0),
+            oldsum[2] + tf.cast(tf.shape(tmpbat[0])[0], tf.float64)))
+    datmen = (tmpsum[0] / tmpsum[2]).numpy()
+    # clamp the cancellation error of near-constant features (a negative 
+    # variance would turn the normalized inputs into nan)
+    datvar = np.maximum((tmpsum[1] / tmpsum[2]).numpy() - datmen**2, 0.0)
     
-    # split into training and testing datasets
-    trnsiz = int((trnper/100) * len(datfin))
-    # training dataset
-    retn01 = fullda.take(trnsiz)
-    # testing dataset
-    retn02 = fullda.skip(trnsiz)
-        
+    # training dataset (reshuffled every epoch, parsed per batch and prefetched)
+    retn01 = shrred(shrfil[:trnsiz], shufle)
     if shufle == True:
-        retn01 = retn01.shuffle(trnsiz)
-        tstsiz = len(datfin) - trnsiz
-        retn02 = retn02.shuffle(tstsiz)
-        
-    retn01 = retn01.batch(batchn)
+        retn01 = retn01.shuffle(10000, reshuffle_each_iteration = True)
+    retn01 = retn01.batch(batchn, drop_remainder = True)
+    retn01 = retn01.map(shrprs, num_parallel_calls = tf.data.AUTOTUNE)
+    retn01 = retn01.prefetch(tf.data.AUTOTUNE)
+    # testing dataset
+    retn02 = shrred(shrfil[trnsiz:], False)
     retn02 = retn02.batch(batchn)
-    retn03 = datmin
-    retn04 = datmax
+    retn02 = retn02.map(shrprs, num_parallel_calls = tf.data.AUTOTUNE)
+    retn02 = retn02.prefetch(tf.data.AUTOTUNE)
+    retn03 = datmen
+    retn04 = datvar
     
     return retn01, retn02, retn03, retn04
 
+# function to read the required sites from an hdf5 file
+def h5read(filnam, sitreq, timwin = None, chnksz = 1000):
+    """
+    Script to read the data of the required fluxnet sites from an hdf5 file. 
+    Files stored in the "table" format are read in blocks of time steps and 
+    only the required sites of every block are kept, so the full file is never 
+    held in memory (the whole rows are still read from disk, which is slower 
+    than reading the "fixed" format). Files in the "fixed" format can only be 
+    read entirely before subsetting. The data is returned in single precision, 
+    which is what the deep neural network uses
+
+    Parameters
+    ----------
+    filnam : string
+        full path to the hdf5 file
+    sitreq : list or pd.CategoricalIndex
+        list of fluxnet sites
+    timwin : tuple, optional
+        first and last time step to be read (both included), by default all 
+        the time steps are read. Only the rows in between are read from a 
+        "table" file (the time steps are expected in increasing order)
+    chnksz : integer, optional
+        number of time steps read at a time from a "table" file
+
+    Returns
+    -------
+    retn01 : A pandas data frame (time x sites) with only the required sites
+
+    """
+    with pd.HDFStore(filnam, mode = "r") as h5stor:
+        # like pd.read_hdf, only files with a single dataset can be read
+        if len(h5stor.keys()) != 1:
+            raise ValueError("key must be provided when HDF5 file contains "
+                             "multiple datasets: " + filnam)
+        h5keys = h5stor.keys()[0]
+        if h5stor.get_storer(h5keys).is_table:
+            # rows of the required time steps (only the index is read here)
+            rowbeg, rowend = None, None
+            if timwin is not None:
+                timidx = pd.Index(h5stor.select_column(h5keys, "index"))
+                rowbeg = timidx.searchsorted(timwin[0], side = "left")
+                rowend = timidx.searchsorted(timwin[1], side = "right")
+            # the column selection is applied to every block after it has 
+            # been read, so only one block holds the other sites
+            tmpblk = h5stor.select(h5keys, columns = list(sitreq), 
+                                   start = rowbeg, stop = rowend,
+                                   chunksize = chnksz)
+            tmpblk = [j for j in tmpblk]
+            if len(tmpblk) == 0:
+                tmpblk = [h5stor.select(h5keys, columns = list(sitreq), 
+                                        start = 0, stop = 0)]
+            retn01 = pd.concat(tmpblk)
+        else:
+            retn01 = h5stor.get(h5keys).loc[:, sitreq]
+            if timwin is not None:
+                retn01 = retn01.loc[timwin[0]:timwin[1]]
+    retn01 = retn01.astype(np.float32, copy = False)
+    
+    return retn01
+
 # kling gupta efficiency
+@tf.function(jit_compile = True)
 def kge(actual, predct):
     """
     a custom loss function based on the Kling Gupta Efficiency
@@ -234,6 +474,8 @@ def kge(actual, predct):
                Implications for improving hydrological modelling. (2009). 
                Journal of Hydrology, 377(1–2), 80–91. 
                DOI: https://doi.org/10.1016/j.jhydrol.2009.08.003
+    the means, standard deviations and covariance are derived from sums 
+    computed in a single pass over the data, which XLA fuses into one kernel
 
     Parameters
     ----------
@@ -248,18 +490,30 @@ def kge(actual, predct):
         The loss function to be minimized
 
     """
+    # >>> first and second order moments
+    crsprd = tf.multiply(actual, predct)
+    actnum = tf.cast(tf.size(actual), actual.dtype)
+    prenum = tf.cast(tf.size(predct), predct.dtype)
+    crsnum = tf.cast(tf.size(crsprd), crsprd.dtype)
+    acmean = tf.math.reduce_sum(actual) / actnum
+    pdmean = tf.math.reduce_sum(predct) / prenum
+    acmsqr = tf.math.reduce_sum(tf.multiply(actual, actual)) / actnum
+    pdmsqr = tf.math.reduce_sum(tf.multiply(predct, predct)) / prenum
+    crsmen = tf.math.reduce_sum(crsprd) / crsnum
+    # (the small epsilon keeps the gradient of the square root finite when 
+    #  float32 cancellation pushes the variance of a near-constant batch to 0)
+    actstd = tf.math.sqrt(tf.math.maximum(acmsqr - acmean**2, 0.0) + 1e-8)
+    prestd = tf.math.sqrt(tf.math.maximum(pdmsqr - pdmean**2, 0.0) + 1e-8)
+    
     # >>> correlation
-    acmean = tf.math.reduce_mean(actual)
-    pdmean = tf.math.reduce_mean(predct)
-    acmdev, pdmdev = actual - acmean, predct - pdmean
-    cornum = tf.math.reduce_mean(tf.multiply(acmdev, pdmdev))        
-    corden = tf.math.reduce_std(acmdev) * tf.math.reduce_std(pdmdev)
+    # (removing the mean does not change the standard deviation, so the 
+    #  denominator is simply the product of the two standard deviations)
+    cornum = crsmen - acmean * pdmean
+    corden = actstd * prestd
     corcof = cornum / corden
     cratio = (corcof - 1)**2
     
     # variability ratio
-    actstd = tf.math.reduce_std(actual)
-    prestd = tf.math.reduce_std(predct)
     stdrat = prestd / actstd
     vratio = (stdrat - 1)**2
     
@@ -273,7 +527,7 @@ def kge(actual, predct):
     return retn01
 
 # deep learning model
-def funmod(inpshp, losobj, metric, optmod):
+def funmod(inpshp, losobj, metric, optmod, nrmmen, nrmvar):
     """
     Function to create a machine learning model using the Functional API module
     of tensorflow. This module can be used to create more powerful machine
@@ -289,6 +543,10 @@ def funmod(inpshp, losobj, metric, optmod):
         A tensorflow error metric function
     optmod : character
         An optimizer which is available in tensorflow
+    nrmmen : array
+        The mean values of the input variables used to normalize the inputs
+    nrmvar : array
+        The variances of the input variables used to normalize the inputs
 
     Returns
     -------
@@ -299,18 +557,22 @@ def funmod(inpshp, losobj, metric, optmod):
     print(" >>> creating a Functional API model")
     # define the input layers
     inplyr = tf.keras.Input(shape = (inpshp, ))
+    # normalize the inputs (kept in float32 under mixed precision)
+    nrmlyr = tf.keras.layers.Normalization(mean = nrmmen, 
+                                           variance = nrmvar, 
+                                           dtype = "float32")(inplyr)
     
-    crslyr = tf.keras.layers.Dense(512, activation=tf.nn.swish)(inplyr)
+    crslyr = tf.keras.layers.Dense(512, activation=tf.nn.swish)(nrmlyr)
     crslyr = tf.keras.layers.Dropout(0.45)(crslyr)
     crslyr = tf.keras.layers.Dense(256, activation=tf.nn.swish)(crslyr)
     crslyr = tf.keras.layers.Dropout(0.3)(crslyr)
     
-    seqlyr = tf.keras.layers.Dense(792, activation=tf.nn.swish)(inplyr)
+    seqlyr = tf.keras.layers.Dense(792, activation=tf.nn.swish)(nrmlyr)
     seqlyr = tf.keras.layers.Dropout(0.45)(seqlyr)
     seqlyr = tf.keras.layers.Dense(512, activation=tf.nn.gelu)(seqlyr)
     seqlyr = tf.keras.layers.Dropout(0.45)(seqlyr)
     
-    concat = tf.keras.layers.concatenate([crslyr, seqlyr, inplyr])
+    concat = tf.keras.layers.concatenate([crslyr, seqlyr, nrmlyr])
     
     outlyr = tf.keras.layers.Dense(768, activation=tf.nn.swish)(concat)
     outlyr = tf.keras.layers.Dropout(0.4)(outlyr)
@@ -318,17 +580,15 @@ def funmod(inpshp, losobj, metric, optmod):
     outlyr = tf.keras.layers.Dropout(0.4)(outlyr)
     outlyr = tf.keras.layers.Dense(256, activation=tf.nn.swish)(outlyr)
     outlyr = tf.keras.layers.Dropout(0.4)(outlyr)
-    conca1 = tf.keras.layers.concatenate([outlyr, inplyr])
-    outly1 = tf.keras.layers.Dense(256, activation=tf.nn.swish)(conca1)
-    outly1 = tf.keras.layers.Dropout(0.3)(outly1)
     outly1 = tf.keras.layers.Dense(172, activation=tf.nn.swish)(outlyr)
-    outly1 = tf.keras.layers.Dropout(0.35)(outlyr)
-    conca2 = tf.keras.layers.concatenate([outly1, inplyr])
+    outly1 = tf.keras.layers.Dropout(0.35)(outly1)
+    conca2 = tf.keras.layers.concatenate([outly1, nrmlyr])
 
     outly2 = tf.keras.layers.Dense(128, activation=tf.nn.swish)(conca2)
     outly2 = tf.keras.layers.Dropout(0.3)(outly2)
     outly2 = tf.keras.layers.Dense(64, activation=tf.nn.gelu)(outly2)
-    outmod = tf.keras.layers.Dense(6)(outly2)
+    # keep the output in float32 so that the loss is computed in full precision
+    outmod = tf.keras.layers.Dense(6, dtype = "float32")(outly2)
     
     # combine the layers into a full model
     tmpmod = tf.keras.Model(inputs = inplyr, 
@@ -339,10 +599,12 @@ def funmod(inpshp, losobj, metric, optmod):
     losobj = losobj
     # define a metric function
     metric = [metric]
-    # compile the model
+    # compile the model (with XLA, which fuses the dense/activation/dropout 
+    # layers into fewer kernels)
     tmpmod.compile(optimizer = optmod, 
                    loss = losobj, 
-                   metrics = metric)
+                   metrics = metric,
+                   jit_compile = True)
     # return the compiled model
     retn01 = tmpmod
     